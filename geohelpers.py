@@ -1,7 +1,16 @@
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
+import pyarrow.parquet as pq
 import os
+import functools
+import hashlib
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+
+VALID_ACCURACY_M = frozenset({1, 10, 100, 1000, 10000, 100000})
+CACHE_DIR = os.path.join('processed_data', '.cache')
 
 def _check_chunksize(chunksize, df_size):
     '''Check that the chunksize is reasonable given the size of the data'''
@@ -11,14 +20,6 @@ def _check_chunksize(chunksize, df_size):
         chunksize = min(max(df_size//50,5000), 60000)
     return chunksize
 
-def cartesian_product(*arrays):
-    '''
-    Perform a cartesian product on the provided arrays
-    arrays: numpy arrays or lists
-    '''
-    ndim = len(arrays)
-    return np.stack(np.meshgrid(*arrays), axis=-1).reshape(-1, ndim)
-
 def generate_key(df, accuracy_m=1000, lats='latitude',longs='longitude'):
     '''
     Generate the key based on the selected level of accuracy
@@ -27,54 +28,48 @@ def generate_key(df, accuracy_m=1000, lats='latitude',longs='longitude'):
     lats(str): (optional) specify the name of the column containing the latitudes
     longs(str): (optional) specify the name of the column containing the longitudes
     Returns: dataframe with generated key columns attached (will replace existing 'key' column if present)
+    Note: df is modified in place (lats and longs are rounded) - pass a copy if the original values are needed
     '''
     print('Generating the geokey')
     # ensure that the lats and longs correspond with the selected accuracy
     round_level = int(5 - np.log10(accuracy_m))
-    df = df.copy()
-    df[lats] = df[lats].round(round_level)
-    df[longs] = df[longs].round(round_level)
-    df['geokey'] = (df[lats]*100000).astype(int).astype(str) \
-            +';'+ (df[longs]*100000).astype(int).astype(str)
+    # work on integer multiples of 1e-5 degrees so the key never depends on float truncation
+    scale, step = 10**round_level, 10**(5 - round_level)
+    lat_f = df[lats].to_numpy(dtype=np.float64)
+    long_f = df[longs].to_numpy(dtype=np.float64)
+    # casting NaN/inf to int64 gives garbage that looks like a valid key
+    if not (np.isfinite(lat_f).all() and np.isfinite(long_f).all()):
+        raise ValueError(f'Cannot generate the geokey: {lats} and {longs} contain missing or non-finite values')
+    lat_i = np.rint(lat_f * scale).astype(np.int64) * step
+    long_i = np.rint(long_f * scale).astype(np.int64) * step
+    df[lats] = lat_i / 100000
+    df[longs] = long_i / 100000
+    df['geokey'] = np.char.add(np.char.add(lat_i.astype(str), ';'), long_i.astype(str))
     return df
 
-def generate_points_from_coordinates(df, chunksize=None, lats='latitude',longs='longitude'):
+def generate_points_from_coordinates(df, lats='latitude',longs='longitude'):
     '''
     Generate a Point geometries column from the latitudes and longitudes
     df(dataframe): pandas-like dataframe containing the latitudes and longitudes to be converted to Points
     '''
     print('Generating the geometry points from the coordinates')
-    chunksize = _check_chunksize(chunksize, df.shape[0])
-    print(f'selected chunksize {chunksize}', flush=True, end='')
-    dfs = []
-    for df_chunk in _chunker(df, chunksize):
-        df_ret = gpd.GeoDataFrame(df_chunk, geometry=gpd.points_from_xy(df_chunk[longs],df_chunk[lats]))
-        df_ret.crs = {'init': 'epsg:4326'}
-        dfs.append(df_ret)
-        print('.', flush=True, end='')
-    print('Done!')
-    return pd.concat(dfs)
-
-def _generate_smaller_grid(lats, longs, accuracy_m, verbose):
-    '''For use with generate grid'''
-    mlat, mlong = len(lats), len(longs)
-    if max(mlat,mlong) >= 1500:
-        # potentially too large to handle in one go...dividing and conquering
-        dfs = []
-        if mlat>mlong: 
-            for lat in np.array_split(lats,mlat//100):
-                dfs += [_generate_smaller_grid(lat,longs,accuracy_m,verbose)]
-        else:
-            for lon in np.array_split(longs,mlong//100):
-                dfs += [_generate_smaller_grid(lats,lon,accuracy_m,verbose)]
-        grid = pd.concat(dfs)
-        if verbose: print('collecting results')
+    geometry = gpd.points_from_xy(df[longs].to_numpy(), df[lats].to_numpy())
+    return gpd.GeoDataFrame(df, geometry=geometry, crs='EPSG:4326')
 
-    else:
-        if verbose: print('.',end='',flush=True)
-        cols=['latitude','longitude']
-        grid = pd.DataFrame(cartesian_product(lats,longs), columns=cols)
-    return grid
+def _check_accuracy(accuracy_m):
+    '''Check that accuracy_m is one of the supported grid spacings'''
+    try:
+        accuracy_m = int(accuracy_m)
+    except (TypeError, ValueError):
+        accuracy_m = None
+    if accuracy_m not in VALID_ACCURACY_M:
+        raise ValueError('accuracy_m must be one of these values: (1,10,100,1000,10000,100000)')
+    return accuracy_m
+
+def _grid_axes(lats, longs, accuracy_m):
+    '''Latitudes and longitudes spaced accuracy_m apart, covering the (min,max) ranges in lats, longs'''
+    steps = accuracy_m/100000
+    return np.arange(np.min(lats), np.max(lats), steps), np.arange(np.min(longs), np.max(longs), steps)
 
 def generate_grid(lats, longs, accuracy_m=1000, verbose=False):
     '''Create accuracy_m spaced grid using (min,max) pairs provided in lats, longs
@@ -84,19 +79,13 @@ def generate_grid(lats, longs, accuracy_m=1000, verbose=False):
     verbose(bool): set verbosity level
     Returns: GeoDataFrame with latitudes, longitudes, coordinates and constructed key
     '''
-    try:
-        accuracy_m = int(accuracy_m)
-        if not accuracy_m in (10**x for x in range(6)):
-            raise ValueError('accuracy_m not in (1,10,100,1000,10000,100000)')
-    except Exception:
-        raise ValueError('accuracy_m must be one of these values: (1,10,100,1000,10000,100000)')
-    
-    steps = accuracy_m/100000
+    accuracy_m = _check_accuracy(accuracy_m)
 
     print('Generating point grid')
-    lats = np.arange(np.min(lats), np.max(lats), steps)
-    longs = np.arange(np.min(longs), np.max(longs), steps)
-    ret = _generate_smaller_grid(lats,longs,accuracy_m,verbose).reset_index(drop=True)
+    lats, longs = _grid_axes(lats, longs, accuracy_m)
+    # build the columns directly rather than transposing an (N, 2) array into the frame
+    ret = pd.DataFrame({'latitude': np.repeat(lats, longs.size),
+                        'longitude': np.tile(longs, lats.size)})
     print(f'\nGrid of size {ret.shape} generated!')
     return ret
 
@@ -107,55 +96,198 @@ def _chunker(df, chunksize=None):
     returns: generator of dfs with at most chunksize rows or at most chunks entries
     '''
     if not chunksize:
-        return [df]
-    df_in = df.copy()
-    dfs = []
-    for (g,df) in df_in.groupby(np.arange(df_in.shape[0]) // chunksize):
-        dfs+=[df]
-    return dfs
+        yield df
+        return
+    for start in range(0, df.shape[0], chunksize):
+        yield df.iloc[start:start+chunksize]
+
+def _spread_bits(values):
+    '''Spread the lower 16 bits of each value so that a zero bit sits between every original bit'''
+    values = values.astype(np.uint64)
+    for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+def _spatial_order(x, y, bits=16):
+    '''
+    Order in which to visit the (x, y) coordinates so that points that are close together stay together.
+    The coordinates are binned onto a 2**bits grid over their bounding box and sorted along a Morton (Z-order) curve
+    x(array-like): x-coordinates (longitudes) of the points
+    y(array-like): y-coordinates (latitudes) of the points
+    Returns: array of positional indices
+    '''
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if x.size == 0:
+        return np.arange(0)
+    def _bin(values):
+        span = values.max() - values.min()
+        scaled = (values - values.min()) / span if span > 0 else np.zeros_like(values)
+        return np.rint(scaled * (2**bits - 1))
+    morton = _spread_bits(_bin(x)) | (_spread_bits(_bin(y)) << np.uint64(1))
+    return np.argsort(morton, kind='stable')
+
+def do_join(points, geometries, columns=None):
+    '''
+    Helper to do the geometry join: attach the columns of the geometries containing each point
+    (points within several geometries are repeated, points within none are dropped).
+    Like gpd.sjoin, column names present in both are suffixed with _left and _geometries
+    columns(list): (optional) columns of geometries to attach to the located points (Default: all)
+    '''
+    if columns is None:
+        columns = [col for col in geometries if col != geometries.geometry.name]
+    # positions of the (point, geometry) pairs for which the point is within the geometry
+    point_pos, geometry_pos = geometries.sindex.query(points.geometry, predicate='within')
+    located = points.iloc[point_pos]
+    attributes = {'index_geometries': geometries.index[geometry_pos]}
+    for col in columns:
+        attributes[col] = geometries[col].array.take(geometry_pos)
+    attributes = pd.DataFrame(attributes, index=located.index)
+    shared = [col for col in attributes if col in located]
+    if shared:
+        located = located.rename(columns={col: f'{col}_left' for col in shared})
+        attributes = attributes.rename(columns={col: f'{col}_geometries' for col in shared})
+    return pd.concat([located, attributes], axis=1)
+
+_worker_geometries = None
+_worker_columns = None
+
+def _init_join_worker(geometries, columns):
+    '''Receive the geometries (and build their spatial index) once per worker process'''
+    global _worker_geometries, _worker_columns
+    _worker_geometries, _worker_columns = geometries, columns
+    _worker_geometries.sindex
+
+def _do_join_in_worker(points):
+    '''Join a chunk of points against the geometries held by the worker process'''
+    return do_join(points, _worker_geometries, _worker_columns)
 
-def do_join(points, geometries):
+def _join_chunks(chunks, geometries, n_jobs=1, columns=None):
     '''
-    Helper to do the geometry join
+    Yield the join of each chunk of points with the geometries, in the order of the chunks
+    n_jobs(int): number of worker processes to spread the chunks over
+    columns(list): (optional) columns of geometries to attach to the located points (Default: all)
     '''
-    joined = gpd.sjoin(points, geometries, how='inner', op='within', rsuffix='geometries')
-    return joined
+    if n_jobs <= 1:
+        for small_points in chunks:
+            yield do_join(small_points, geometries, columns)
+        return
+    with ProcessPoolExecutor(n_jobs, initializer=_init_join_worker, initargs=(geometries, columns)) as executor:
+        yield from executor.map(_do_join_in_worker, chunks)
 
-def locate_points(points, geometries, chunksize=None, verbose=False):
+def locate_points(points, geometries, chunksize=None, verbose=False, n_jobs=None, columns=None):
     '''
     Locate the points within the provided geometries
     points(geopandasdf): GeoPandasDF containing a single column of Points to locate in geometries
     geometries(geopandasdf): GeoPandasDF conatining a single column of Geometries
+    (pass the same object to every call so that its spatial index is only built once)
     chunksize(int): (optional) specify the size of the chunks in which to process the points
     verbose(bool): Do you want all the information? (Default False)
+    n_jobs(int): (optional) number of processes used to join the chunks (Default: all cpus)
+    columns(list): (optional) columns of geometries to attach to the located points (Default: all)
     '''
     print('Locating the points')
     results = []
     chunksize = _check_chunksize(chunksize, points.shape[0])
     if points.shape[0] > 500000:
         print('There are many points to locate - this is going to take a while!')
+    # keep each chunk spatially compact so that it only hits the geometries in its own neighbourhood
+    order = _spatial_order(points.geometry.x, points.geometry.y)
+    ordered = points.iloc[order]
+    # label the rows by their original position, so that the input order can be restored after the join
+    ordered.index = order
+    chunks = list(_chunker(ordered, chunksize))
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(chunks))
+    if verbose: print(f'Joining {len(chunks)} chunks using {n_jobs} processes')
     n,steps = 0,0
-    for small_points in _chunker(points, chunksize):
+    for small_points, small_join in zip(chunks, _join_chunks(chunks, geometries, n_jobs, columns)):
         if verbose: print('.',flush=True,end='')
-        small_join = do_join(small_points, geometries)
         results += [small_join]
         steps += 1
         n += small_points.shape[0]
         if steps%10==0:
             print(f' ({n} of {points.shape[0]} [{n*100//points.shape[0]}%] processed)')
     print('Combining results')
-    ret = pd.concat(results)
+    # restore the original (positional) order of the points
+    ret = pd.concat(results).sort_index(kind='stable')
     print(f'Done!')
     if verbose: 
         print(f'{ret.shape[0]} of {points.shape[0]} located within geometries')
         print(f'{points.shape[0] - ret.shape[0]} points were not found within provided geometries!')
     return ret.reset_index(drop=True)
 
+def rasterize_grid(lats, longs, geometries, verbose=False):
+    '''
+    Find the geometry containing each point of the regular grid spanned by lats and longs
+    lats(array-like): sorted latitudes of the grid rows
+    longs(array-like): sorted longitudes of the grid columns
+    geometries(geopandasdf): GeoPandasDF conatining a single column of Geometries
+    verbose(bool): Do you want all the information? (Default False)
+    Returns: int32 array of shape (len(lats), len(longs)) holding the position of the containing geometry
+    in geometries, or -1 where the point is not within any of the geometries
+    '''
+    print('Rasterizing the geometries onto the grid')
+    lats, longs = np.asarray(lats, dtype=np.float64), np.asarray(longs, dtype=np.float64)
+    if geometries.crs is not None and geometries.crs != 'EPSG:4326':
+        # the grid is defined in degrees
+        geometries = geometries.to_crs('EPSG:4326')
+    raster = np.full((lats.size, longs.size), -1, dtype=np.int32)
+    bounds = geometries.geometry.bounds.to_numpy()
+    for pos, geometry in enumerate(geometries.geometry):
+        if geometry is None or geometry.is_empty:
+            continue
+        # only the grid points within the bounding box of the geometry need to be tested
+        minx, miny, maxx, maxy = bounds[pos]
+        r0, r1 = np.searchsorted(lats, miny, 'left'), np.searchsorted(lats, maxy, 'right')
+        c0, c1 = np.searchsorted(longs, minx, 'left'), np.searchsorted(longs, maxx, 'right')
+        block = raster[r0:r1, c0:c1]
+        rows, cols = np.nonzero(block == -1)
+        if rows.size == 0:
+            continue
+        shapely.prepare(geometry)
+        inside = shapely.contains_xy(geometry, longs[c0:c1][cols], lats[r0:r1][rows])
+        block[rows[inside], cols[inside]] = pos
+        if verbose and pos%100==0: print('.',flush=True,end='')
+    print('Done!')
+    return raster
+
+def _attach_columns(df, geometries, positions, columns=None):
+    '''Attach the columns of the geometries at the given positions to the rows of df'''
+    if columns is None:
+        columns = [col for col in geometries if col != geometries.geometry.name]
+    attributes = pd.DataFrame(geometries[columns]).iloc[positions].reset_index(drop=True)
+    return pd.concat([df.reset_index(drop=True), attributes], axis=1)
+
+def generate_located_grid(lats, longs, geometries, accuracy_m=1000, verbose=False, columns=None):
+    '''
+    Create the accuracy_m spaced grid (see generate_grid) and locate it within the geometries in one step.
+    Only the grid points that fall within the geometries are ever created
+    longs(array-like): min,max values for longitude range
+    lats(array-like): min,max values for latitude range
+    geometries(geopandasdf): GeoPandasDF conatining a single column of Geometries
+    accuracy_m(int): desired approximate accuracy in meters from (1,10,100,1000,10000,100000)
+    verbose(bool): Do you want all the information? (Default False)
+    columns(list): (optional) columns of geometries to attach to the located points (Default: all)
+    Returns: dataframe of the grid points that are within the geometries, with key and the geometries' columns attached
+    '''
+    accuracy_m = _check_accuracy(accuracy_m)
+    # round the axes the same way generate_key would, so that the points are tested where they will end up
+    scale = 100000 // accuracy_m
+    lat_axis, long_axis = (np.rint(axis * scale) / scale for axis in _grid_axes(lats, longs, accuracy_m))
+    raster = rasterize_grid(lat_axis, long_axis, geometries, verbose)
+    print('Generating located point grid')
+    rows, cols = np.nonzero(raster >= 0)
+    grid = pd.DataFrame({'latitude': lat_axis[rows], 'longitude': long_axis[cols]})
+    grid = generate_key(grid, accuracy_m)
+    ret = _attach_columns(grid, geometries, raster[rows, cols], columns)
+    print(f'Grid of size {ret.shape} generated ({raster.size - ret.shape[0]} points outside of the geometries skipped)!')
+    return ret
+
 def save_data(df, filename='filename.json.gz', directory='processed_data', columns=None, skip_checks=True):
     '''
-    Save the data in json records format, optionally only keeping certain columns
+    Save the data in parquet or json records format, optionally only keeping certain columns
     df(dataframe): dataframe to save
-    filename(str): the name of the destination filename, including extension and compression
+    filename(str): the name of the destination filename, including extension and compression.
+    Filenames ending in .parquet are written as zstd-compressed parquet, anything else as json records
     directory(str): the directory in which to save the files
     columns(list/dict): list of columns to keep in the saved file.  
     If dictionary is passed in columns, the keys will be used to filter the df 
@@ -168,26 +300,112 @@ def save_data(df, filename='filename.json.gz', directory='processed_data', colum
         else:
             df = df[columns.keys()]
             df = df.rename(columns=columns)
-    df = pd.DataFrame(df)
-    try:
-        # Create target Directory
-        os.mkdir(directory)
-        print(f"Directory {directory} created")
-    except FileExistsError:
-        print(f"Directory {directory} already exists")
+    # Create target Directory (if needed)
+    os.makedirs(directory, exist_ok=True)
     full_pathname = os.path.join(directory,filename)
     print(f'Writing file at {full_pathname}')
-    df.to_json(full_pathname,orient='records')
+    if filename.endswith('.parquet'):
+        # GeoDataFrames are written as GeoParquet so that their geometries are preserved
+        df.to_parquet(full_pathname, compression='zstd')
+    else:
+        pd.DataFrame(df).to_json(full_pathname,orient='records')
+    df = pd.DataFrame(df)
     if not skip_checks:
         check_first_col(df)
     return df
 
-def process_dataframe(df, geometries, accuracy_m=1000, chunksize=None, verbose=False):
-    chunksize = _check_chunksize(chunksize, df.shape[0])
-    df = generate_key(df, accuracy_m)
-    df = generate_points_from_coordinates(df, chunksize)
-    df = locate_points(df, geometries, chunksize, verbose)
-    return df
+def _hash_value(value):
+    '''Digest of the contents of a (Geo)DataFrame, or of the repr of any other value'''
+    digest = hashlib.sha1()
+    if isinstance(value, pd.DataFrame):
+        digest.update(repr(list(value.columns)).encode())
+        if isinstance(value, gpd.GeoDataFrame):
+            digest.update(str(value.crs).encode())
+            for wkb in shapely.to_wkb(value.geometry.values):
+                digest.update(b'\x00' if wkb is None else wkb)
+            value = pd.DataFrame(value.drop(columns=value.geometry.name))
+        digest.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+    else:
+        digest.update(repr(value).encode())
+    return digest.digest()
+
+def _prune_cache(cache_dir, prefix, max_entries):
+    '''Remove all but the max_entries most recently used cache files starting with prefix'''
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+               if name.startswith(prefix) and name.endswith('.parquet')]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for full_pathname in entries[max_entries:]:
+        print(f'Removing stale cache file {full_pathname}')
+        os.remove(full_pathname)
+
+def disk_cached(*key_args, max_entries=10):
+    '''
+    Decorator that caches the (Geo)DataFrame returned by a function as a parquet file,
+    keyed on the contents of the named arguments and on the source code of the module defining the
+    function (so that code changes never serve stale results).  The decorated function accepts an extra
+    cache_dir argument (Default: processed_data/.cache) - pass cache_dir=None to bypass the cache
+    key_args(str): names of the arguments that determine the result of the function
+    max_entries(int): number of most recently used results of the function to keep in the cache
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+        try:
+            salt = inspect.getsource(inspect.getmodule(func)).encode()
+        except (OSError, TypeError):
+            salt = b''
+        @functools.wraps(func)
+        def wrapper(*args, cache_dir=CACHE_DIR, **kwargs):
+            if not cache_dir:
+                return func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = hashlib.sha1(func.__name__.encode() + salt)
+            for name in key_args:
+                key.update(_hash_value(bound.arguments[name]))
+            prefix = f'{func.__name__}_'
+            full_pathname = os.path.join(cache_dir, f'{prefix}{key.hexdigest()}.parquet')
+            if os.path.exists(full_pathname):
+                print(f'Reading cached result from {full_pathname}')
+                # mark the entry as recently used
+                os.utime(full_pathname)
+                if b'geo' in (pq.read_schema(full_pathname).metadata or {}):
+                    return gpd.read_parquet(full_pathname)
+                return pd.read_parquet(full_pathname)
+            ret = func(*args, **kwargs)
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file first so that an interrupted run never leaves a partial cache entry
+            ret.to_parquet(full_pathname + '.tmp')
+            os.replace(full_pathname + '.tmp', full_pathname)
+            _prune_cache(cache_dir, prefix, max_entries)
+            return ret
+        return wrapper
+    return decorator
+
+@disk_cached('df', 'geometries', 'accuracy_m', 'columns')
+def process_dataframe(df, geometries, accuracy_m=1000, chunksize=None, verbose=False, n_jobs=None, columns=None):
+    '''
+    Generate the geokey for the latitudes and longitudes in df and locate them within the geometries.
+    df itself is not modified - the results are cached on disk (see disk_cached)
+    df(dataframe): pandas-like dataframe containing latitude and longitude columns
+    geometries(geopandasdf): GeoPandasDF conatining a single column of Geometries
+    accuracy_m(int): desired accuracy (in meters) - should be consistent with rest of the data
+    chunksize, verbose, n_jobs, columns: see locate_points
+    Returns: GeoDataFrame of the rows of df located within the geometries, with geokey and the geometries' columns attached
+    '''
+    # key a copy of the coordinates only, so that the caller's df is left untouched
+    coords = generate_key(df[['latitude','longitude']].copy(), accuracy_m)
+    # rows sharing a geokey have the same (rounded) coordinates, so each key only needs to be located once
+    keys = coords.drop_duplicates('geokey')
+    if verbose: print(f'{keys.shape[0]} unique geokeys among {df.shape[0]} rows')
+    # only the geokey and geometry are located - the rounded coordinates come back via coords
+    points = generate_points_from_coordinates(keys)[['geokey', 'geometry']]
+    if geometries.crs is not None and points.crs != geometries.crs:
+        # reproject the points once rather than leaving the join to deal with mismatched crs
+        points = points.to_crs(geometries.crs)
+    located = locate_points(points, geometries, chunksize, verbose, n_jobs, columns)
+    df = df.assign(**{col: coords[col].to_numpy() for col in coords})
+    df = df.merge(located, how='inner', on='geokey', suffixes=('_left', '_geometries'))
+    return gpd.GeoDataFrame(df, geometry=located.geometry.name, crs=located.crs)
 
 def check_table_key(df, key):
     '''
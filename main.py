@@ -12,24 +12,31 @@ def load_raw_data():
                 'feature_class', 'feature_code', 'country_code', 'cc2',
                 'admin1_code', 'admin2_code', 'admin3_code', 'admin4_code',
                 'population', 'elevation', 'dem', 'timezone', 'modification_date',]
-    geonames = pd.read_csv('data/geonames.tsv', sep='\t', names=geo_cols, dtype=object)
+    # parse the numeric columns directly, keep everything else as text
+    geo_dtypes = dict.fromkeys(geo_cols, object)
+    geo_dtypes.update({'geonameid':'int64', 'latitude':'float64', 'longitude':'float64', 'population':'int64'})
+    geonames = pd.read_csv('data/geonames.tsv', sep='\t', names=geo_cols, dtype=geo_dtypes,
+                           engine='c', low_memory=False)
     geonames['f_code'] = geonames.feature_class.astype(str)+'.'+(geonames.feature_code).astype(str)
     geofeats_cols = ['f_code','desc_short','desc_long']
     geofeats = pd.read_csv('data/geonames_features.tsv', sep='\t', names=geofeats_cols)
     geonames = geonames.merge(geofeats, how='left',on='f_code')
-    geonames[['latitude','longitude']] = geonames[['latitude','longitude']].astype(float)
-    geonames[['geonameid','population']] = geonames[['geonameid','population']].astype(int)
 
     print('Reading postal codes')
     pc_cols = ['country_code', 'postal_code', 'place_name', 
                'admin_name1', 'admin_code1', 'admin_name2', 'admin_code2', 
                'admin_name3', 'admin_code3', 'latitude', 'longitude', 'accuracy',]
-    postal_codes = pd.read_csv('data/postal_codes.tsv', sep='\t', names=pc_cols, dtype={1:object})
-    postal_codes[['latitude','longitude']] = postal_codes[['latitude','longitude']].astype(float)
+    postal_codes = pd.read_csv('data/postal_codes.tsv', sep='\t', names=pc_cols, engine='c',
+                               dtype={'postal_code':object, 'latitude':'float64', 'longitude':'float64'})
 
     print('Reading wards')
+    ward_cols = ['WardID', 'WardNumber', 'Shape_Length', 'Shape_Area', 'LocalMunicipalityName',
+                 'DistrictMunicipalityCode', 'DistrictMunicipalityName', 'ProvinceName', 'ProvinceCode',
+                 'geometry',]
     geometries = gpd.read_file('data/MDBWard2016.gdb/').set_geometry('geometry')
-    geometries = geometries.drop(columns=[])
+    geometries = geometries[ward_cols]
+    # build the spatial index once - it is reused by every lookup against these geometries
+    geometries.sindex
     
     print('All files read!')
     
@@ -39,22 +46,17 @@ def extract_names_datasets(located_geonames):
     ## Descoped nearest points for now
     ## see here on how to do it: https://gis.stackexchange.com/questions/222315/geopandas-find-nearest-point-in-other-dataframe
     ## or here: https://stackoverflow.com/questions/56520780/how-to-use-geopanda-or-shapely-to-find-nearest-point-in-same-geodataframe
-    lg = located_geonames
-    provinces = pd.DataFrame(lg[lg.feature_code=='ADM1']).reset_index(drop=True)
-    districts = pd.DataFrame(lg[lg.feature_code=='ADM2']).reset_index(drop=True)
-    towns = pd.DataFrame(lg[lg.feature_code=='ADM3']).reset_index(drop=True)
-    suburbs = pd.DataFrame(lg[lg.feature_class=='P']).reset_index(drop=True)
+    lg = pd.DataFrame(located_geonames)
+    fc = lg['feature_code']
+    provinces = lg.loc[fc=='ADM1'].reset_index(drop=True)
+    districts = lg.loc[fc=='ADM2'].reset_index(drop=True)
+    towns = lg.loc[fc=='ADM3'].reset_index(drop=True)
+    suburbs = lg.loc[lg['feature_class']=='P'].reset_index(drop=True)
     return provinces, districts, towns, suburbs
 
 def process_data(accuracy_m=1000, verbose=False):
     geometries, geonames, postal_codes = load_raw_data()
-    points_grid = gh.generate_grid(lats=[-35,-22], longs=[16,33], accuracy_m=accuracy_m, verbose=verbose)
-    gh.check_grid(points_grid)
-    
     print('\nProcessing the generated grid dataset')
-    located_grid = gh.process_dataframe(points_grid, geometries, accuracy_m, verbose=verbose)
-    gh.check_grid(located_grid)
-    del points_grid # free up RAM
     grid_cols = {
         'geokey':'geokey',
         'latitude':'latitude',
@@ -68,12 +70,15 @@ def process_data(accuracy_m=1000, verbose=False):
         'DistrictMunicipalityName':'district_municipality',
         'ProvinceName':'province_code',
         'ProvinceCode':'province_name',}
-    grid = gh.save_data(located_grid, 'located_grid.json.gz','processed_data',columns=grid_cols)
+    located_grid = gh.generate_located_grid(lats=[-35,-22], longs=[16,33], geometries=geometries,
+                                            accuracy_m=accuracy_m, verbose=verbose)
+    gh.check_grid(located_grid)
+    grid = gh.save_data(located_grid, 'located_grid.parquet','processed_data',columns=grid_cols)
     wards = grid.drop(columns=['geokey','latitude','longitude']).drop_duplicates()
     grid = grid[['geokey','ward_id','latitude','longitude']].drop_duplicates()
     
     print('\nProcessing the geonames dataset')
-    located_geonames = gh.process_dataframe(geonames, geometries, accuracy_m, verbose=verbose)
+    located_geonames = gh.process_dataframe(geonames, geometries, accuracy_m, verbose=verbose, columns=['WardID'])
     geonames_cols = {
         'geonameid':'geoname_id',
         'WardID':'ward_id',
@@ -90,11 +95,12 @@ def process_data(accuracy_m=1000, verbose=False):
     located_geonames = located_geonames[list(geonames_cols)]
     located_geonames['desc_long'] = located_geonames['desc_long'].fillna(located_geonames['desc_short'])
     located_geonames = located_geonames.dropna()
-    loc_geo = gh.save_data(located_geonames, 'located_geonames.json.gz','processed_data',columns=geonames_cols)
+    loc_geo = gh.save_data(located_geonames, 'located_geonames.parquet','processed_data',columns=geonames_cols)
     provinces, districts, towns, suburbs = extract_names_datasets(loc_geo)
     
     print('\nProcessing the postal_codes dataset')
-    located_postal_codes = gh.process_dataframe(postal_codes, geometries, accuracy_m, verbose=verbose)
+    located_postal_codes = gh.process_dataframe(postal_codes, geometries, accuracy_m, verbose=verbose,
+                                                columns=['WardID'])
     postal_code_cols = {
         'geokey':'geokey',
         'WardID':'ward_id',
@@ -104,18 +110,18 @@ def process_data(accuracy_m=1000, verbose=False):
         'longitude':'longitude',
         }
     postal_codes_dataset = gh.save_data(located_postal_codes,
-                                        'located_postal_codes.json.gz',
+                                        'located_postal_codes.parquet',
                                         'processed_data',columns=postal_code_cols, 
                                         skip_checks=True)
 
     print('\nSaving datasets')
-    gh.save_data(df=postal_codes_dataset, filename='postal_codes.json.gz', directory='datasets')
-    gh.save_data(df=provinces, filename='provinces.json.gz', directory ='datasets')
-    gh.save_data(df=districts, filename='districts.json.gz', directory ='datasets')
-    gh.save_data(df=towns, filename='towns.json.gz', directory ='datasets')
-    gh.save_data(df=suburbs, filename='suburbs.json.gz', directory ='datasets')
-    gh.save_data(df=wards, filename='wards.json.gz', directory ='datasets')
-    gh.save_data(df=grid, filename='grid.json.gz', directory ='datasets')
+    gh.save_data(df=postal_codes_dataset, filename='postal_codes.parquet', directory='datasets')
+    gh.save_data(df=provinces, filename='provinces.parquet', directory ='datasets')
+    gh.save_data(df=districts, filename='districts.parquet', directory ='datasets')
+    gh.save_data(df=towns, filename='towns.parquet', directory ='datasets')
+    gh.save_data(df=suburbs, filename='suburbs.parquet', directory ='datasets')
+    gh.save_data(df=wards, filename='wards.parquet', directory ='datasets')
+    gh.save_data(df=grid, filename='grid.parquet', directory ='datasets')
     
     print('Done!')
     return (located_grid, located_geonames, located_postal_codes)